@@ -1,22 +1,69 @@
 from flask import Flask, Response, render_template, jsonify, request
-from picamera2 import Picamera2
 import threading
+import queue
 import time
 import io
+import os
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
-import RPi.GPIO as GPIO
-import LCD_1in44
-import LCD_Config
 import socket
+import binascii
+import functools
 import subprocess
-from datetime import datetime, timedelta
+import shutil
+import select
+from datetime import datetime
 import json
 
+# Pi hardware libraries are optional so the web side still runs elsewhere
+try:
+    from picamera2 import Picamera2, MappedArray
+    from picamera2.encoders import MJPEGEncoder, H264Encoder
+    from picamera2.outputs import FileOutput
+    from libcamera import ColorSpace
+except ImportError:
+    Picamera2 = None  # No camera stack; camera operations report an error
+
+try:
+    import RPi.GPIO as GPIO
+except (ImportError, RuntimeError):
+    GPIO = None  # Not on a Pi; the buttons are disabled
+
+try:
+    import LCD_1in44
+    import LCD_Config
+except (ImportError, RuntimeError):
+    LCD_1in44 = None  # No LCD driver; the display is disabled
+
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None  # Fall back to PIL for software JPEG encoding
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # Fall back to the json module for hot JSON endpoints
+
+try:
+    import pybase64
+except ImportError:
+    pybase64 = None  # Fall back to binascii for base64 data URIs
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None  # Fall back to NumPy for the YUV to RGB conversion
+
+try:
+    from waitress import serve
+except ImportError:
+    serve = None  # Fall back to the Flask development server
+
 app = Flask(__name__)
 
 # Allowed CORS origins for external domains
-ALLOWED_ORIGINS = [
+ALLOWED_ORIGINS = frozenset([
     'https://c278f6f4-ba8a-4106-9667-55c7ada4b91c.lovableproject.com',
     'https://bookworm-scanner-vision.lovable.app',
     'https://lovable.dev',
@@ -24,62 +71,61 @@ ALLOWED_ORIGINS = [
     'http://127.0.0.1:3000',  # For local development
     'http://localhost:5173',  # Vite dev server
     'http://127.0.0.1:5173',  # Vite dev server
-]
+])
+
+# Any subdomain of these is allowed too
+ALLOWED_ORIGIN_SUFFIXES = ('.lovable.dev', '.lovable.app')
 
 def is_allowed_origin(origin):
     """Check if the origin is allowed for CORS"""
     if not origin:
         return True  # Allow requests without origin (direct API calls)
-    
-    # Allow any subdomain of lovable.dev
-    if origin.endswith('.lovable.dev') or origin == 'https://lovable.dev':
-        return True
-    
-    # Allow any subdomain of lovable.app
-    if origin.endswith('.lovable.app'):
-        return True
-    
-    # Allow specific origins
-    return origin in ALLOWED_ORIGINS
+    return origin in ALLOWED_ORIGINS or origin.endswith(ALLOWED_ORIGIN_SUFFIXES)
 
+@functools.lru_cache(maxsize=16)
 def get_cors_origin(request_origin):
-    """Get the appropriate CORS origin header value"""
+    """Get the appropriate CORS origin header value (memoised; clients reuse few origins)"""
     if is_allowed_origin(request_origin):
         return request_origin if request_origin else '*'
     return None
 
+# CORS headers that don't depend on the request, built once; browsers
+# may cache preflights for up to a day (Chromium caps this at 2 hours)
+CORS_HEADERS = (
+    ('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-Requested-With'),
+    ('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS'),
+    ('Access-Control-Allow-Credentials', 'true'),
+    ('Access-Control-Max-Age', '86400'),
+)
+
+@functools.lru_cache(maxsize=16)
+def get_cors_headers(request_origin):
+    """Every CORS header for an origin as one tuple, or None if it isn't allowed"""
+    cors_origin = get_cors_origin(request_origin)
+    if not cors_origin:
+        return None
+    return ((('Access-Control-Allow-Origin', cors_origin),) + CORS_HEADERS +
+            (('Vary', 'Origin'),))  # Allow-Origin differs per origin
+
 # Add CORS headers to all responses
 @app.after_request
 def after_request(response):
-    origin = request.headers.get('Origin')
-    cors_origin = get_cors_origin(origin)
-    
-    if cors_origin:
-        response.headers.add('Access-Control-Allow-Origin', cors_origin)
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-Requested-With')
-        response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
-        response.headers.add('Access-Control-Allow-Credentials', 'true')
-        response.headers.add('Access-Control-Max-Age', '3600')  # Cache preflight for 1 hour
+    cors_headers = get_cors_headers(request.headers.get('Origin'))
+    if cors_headers:
+        response.headers.extend(cors_headers)
     
     return response
 
-# Handle preflight OPTIONS requests
-@app.route('/<path:path>', methods=['OPTIONS'])
-def handle_options(path):
-    origin = request.headers.get('Origin')
-    cors_origin = get_cors_origin(origin)
-    
-    response = Response()
-    if cors_origin:
-        response.headers.add('Access-Control-Allow-Origin', cors_origin)
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-Requested-With')
-        response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
-        response.headers.add('Access-Control-Allow-Credentials', 'true')
-        response.headers.add('Access-Control-Max-Age', '3600')
-    else:
-        response.status_code = 403
-    
-    return response
+# Handle preflight OPTIONS requests before Flask's automatic OPTIONS
+# responses get a chance to answer them
+@app.before_request
+def handle_options():
+    if request.method != 'OPTIONS':
+        return None
+    # The CORS headers themselves are added by after_request
+    if get_cors_origin(request.headers.get('Origin')):
+        return Response(status=204)
+    return Response(status=403)
 
 @app.route('/cors-test')
 def cors_test():
@@ -90,7 +136,7 @@ def cors_test():
         "origin": origin,
         "allowed": is_allowed_origin(origin),
         "timestamp": time.time(),
-        "allowed_origins": ALLOWED_ORIGINS,
+        "allowed_origins": sorted(ALLOWED_ORIGINS),
         "lovable_domains_supported": [
             "https://lovable.dev",
             "*.lovable.dev",
@@ -104,47 +150,350 @@ KEY1_PIN = 21  # Start video/streaming
 KEY2_PIN = 20  # Exit program
 KEY3_PIN = 16  # Stop video/streaming
 
+# Each /video_feed, /video_canvas_stream and /video_feed_h264 viewer holds a
+# server worker thread for as long as it watches; keep a couple of the
+# server's threads free for the API endpoints
+SERVER_THREADS = 16
+MAX_STREAM_CLIENTS = SERVER_THREADS - 2
+
+# Each H.264 viewer also takes a VideoCore encoder context and an ffmpeg
+# process on the web core, so far fewer of them fit
+MAX_H264_CLIENTS = 2
+
+# CPU cores for each workload on a 4-core Pi Zero 2 W; core 0 is left to
+# the Wi-Fi/SPI interrupts so network bursts don't stall capture
+APP_CORES = {1, 2, 3}
+CAPTURE_CORES = {1}
+LCD_CORES = {2}
+WEB_CORES = {3}
+
+def pin_to_cores(cores):
+    """Restrict the calling thread (and threads it starts later) to the given cores"""
+    if not hasattr(os, 'sched_setaffinity') or (os.cpu_count() or 1) < 4:
+        return
+    try:
+        os.sched_setaffinity(0, cores)
+    except OSError as e:
+        print(f"Could not set CPU affinity {cores}: {e}")
+
+def split_yuv420(yuv, width=None, height=None):
+    """Split a Picamera2 YUV420 (I420) array into its Y, U and V planes"""
+    # Rows are `stride` bytes, which can be wider than the image; the chroma
+    # planes are packed at half that stride, so crop each plane to the image
+    stride = yuv.shape[1]
+    if width is None:
+        width, height = stride, yuv.shape[0] * 2 // 3
+    y = yuv[:height, :width]
+    u = yuv[height:height + height // 4].reshape(height // 2, stride // 2)[:, :width // 2]
+    v = yuv[height + height // 4:height + height // 2].reshape(height // 2, stride // 2)[:, :width // 2]
+    return y, u, v
+
+if njit is not None:
+    # Single-threaded: each caller is pinned to one core, and a worker pool
+    # started from an unpinned thread would spill back onto core 0
+    @njit(fastmath=True, cache=True)
+    def _yuv420_to_rgb_native(y, u, v, out):
+        """Per-pixel YUV420 to RGB conversion, compiled to native code"""
+        for i in range(y.shape[0]):
+            for j in range(y.shape[1]):
+                luma = np.float32(y[i, j])
+                cb = np.float32(u[i // 2, j // 2]) - 128.0
+                cr = np.float32(v[i // 2, j // 2]) - 128.0
+                out[i, j, 0] = min(max(luma + 1.402 * cr, 0.0), 255.0)
+                out[i, j, 1] = min(max(luma - 0.344136 * cb - 0.714136 * cr, 0.0), 255.0)
+                out[i, j, 2] = min(max(luma + 1.772 * cb, 0.0), 255.0)
+
+def yuv420_to_rgb(yuv, width=None, height=None):
+    """Convert a full-range (sYCC) YUV420 array to an (H, W, 3) RGB array"""
+    y, u, v = split_yuv420(yuv, width, height)
+    if njit is not None:
+        rgb = np.empty(y.shape + (3,), dtype=np.uint8)
+        _yuv420_to_rgb_native(y, u, v, rgb)
+        return rgb
+    
+    y = y.astype(np.float32)
+    
+    # Chroma planes are quarter size, upsample them back to full resolution
+    u = u.repeat(2, axis=0).repeat(2, axis=1).astype(np.float32) - 128.0
+    v = v.repeat(2, axis=0).repeat(2, axis=1).astype(np.float32) - 128.0
+    
+    # JFIF (BT.601 full-range) conversion, matching the configured colour space
+    rgb = np.empty(y.shape + (3,), dtype=np.float32)
+    rgb[..., 0] = y + 1.402 * v
+    rgb[..., 1] = y - 0.344136 * u - 0.714136 * v
+    rgb[..., 2] = y + 1.772 * u
+    return np.clip(rgb, 0, 255).astype(np.uint8)
+
+# Per-thread scratch buffers for the PIL JPEG fallback
+_jpeg_buffers = threading.local()
+
+JPEG_DATA_URI_PREFIX = b'data:image/jpeg;base64,'
+
+def jpeg_data_uri(jpeg_bytes):
+    """Wrap JPEG bytes in a base64 data URI for the JSON endpoints"""
+    if pybase64 is not None:
+        encoded = pybase64.b64encode(jpeg_bytes)  # SIMD (NEON) encoder
+    else:
+        encoded = binascii.b2a_base64(jpeg_bytes, newline=False)
+    return (JPEG_DATA_URI_PREFIX + encoded).decode('ascii')
+
+def encode_jpeg(frame, quality=85, width=None, height=None):
+    """JPEG-encode an RGB or YUV420 array, with libjpeg-turbo when available"""
+    if frame.ndim == 2:
+        # YUV420 is JPEG's native layout, so hand the planes over unconverted;
+        # width/height give the image size when rows are padded to a stride
+        if simplejpeg is not None:
+            y, u, v = split_yuv420(frame, width, height)
+            return simplejpeg.encode_jpeg_yuv_planes(y, u, v, quality=quality, fastdct=True)
+        frame = yuv420_to_rgb(frame, width, height)
+    
+    if simplejpeg is not None:
+        return simplejpeg.encode_jpeg(np.ascontiguousarray(frame), quality=quality,
+                                      colorspace='RGB', fastdct=True)
+    return save_pil_jpeg(Image.fromarray(frame), quality)
+
+def save_pil_jpeg(image, quality=85):
+    """JPEG-encode a PIL image with Pillow into this thread's reused buffer"""
+    # Overwrite this thread's buffer in place rather than growing a new one per frame
+    img_io = getattr(_jpeg_buffers, 'img_io', None)
+    if img_io is None:
+        img_io = _jpeg_buffers.img_io = io.BytesIO()
+    img_io.seek(0)
+    image.save(img_io, format='JPEG', quality=quality)
+    return img_io.getbuffer()[:img_io.tell()].tobytes()
+
+def _render_placeholder(lines, background, text_color):
+    """Render a static 640x480 message frame and return its JPEG bytes"""
+    image = Image.new('RGB', (640, 480), background)
+    draw = ImageDraw.Draw(image)
+    for position, text in lines:
+        draw.text(position, text, fill=text_color)
+    
+    if simplejpeg is None:
+        # Save directly rather than round-tripping the pixels through NumPy
+        return save_pil_jpeg(image, quality=85)
+    # np.asarray, not np.array: the tobytes() export is the only copy made
+    return encode_jpeg(np.asarray(image), quality=85)
+
+SSE_KEEPALIVE = b': keepalive\n\n'
+
+def sse_event(payload):
+    """Server-Sent Events message carrying a JSON payload"""
+    if orjson is not None:
+        return b'data: ' + orjson.dumps(payload) + b'\n\n'
+    return f"data: {json.dumps(payload)}\n\n"
+
+@functools.lru_cache(maxsize=8)
+def render_error_jpeg(lines, background, text_color):
+    """_render_placeholder for error frames that show the exception text (lines as a tuple)"""
+    # The same error tends to repeat while it persists, so recent ones are kept
+    return _render_placeholder(lines, background, text_color)
+
+# Static frames never change, so encode them once instead of per request
+PLACEHOLDER_NO_STREAM_JPEG = _render_placeholder(
+    [((250, 220), "Camera Stream Not Started"), ((280, 240), "Press KEY1 to start")],
+    (0, 0, 0), (255, 255, 255))
+PLACEHOLDER_WEB_DISABLED_JPEG = _render_placeholder(
+    [((250, 220), "Web Streaming Disabled")], (0, 0, 0), (255, 255, 255))
+NO_CAMERA_JPEG = _render_placeholder(
+    [((250, 220), "Camera Not Active")], (0, 0, 0), (255, 255, 255))
+ERROR_FRAME_JPEG = _render_placeholder(
+    [((200, 200), "Frame Error"), ((200, 240), "Attempting recovery...")],
+    'orange', 'black')
+STREAM_FAILED_JPEG = _render_placeholder(
+    [((200, 220), "Web Stream Failed:"), ((200, 240), "Too many errors"),
+     ((200, 260), "Check camera hardware")],
+    'red', 'white')
+CAPTURE_UNAVAILABLE_JPEG = _render_placeholder(
+    [((200, 220), "Camera Not Available"), ((200, 240), "Check camera status")],
+    (255, 0, 0), (255, 255, 255))
+
+# multipart/x-mixed-replace framing around each JPEG in the MJPEG stream
+# The CRLF that ends each part belongs to the next boundary delimiter, so every
+# part is one header chunk plus the frame (the first CRLF is preamble).
+# Content-Length lets clients cut frames out without scanning for markers
+MJPEG_FRAME_HEADER = b'\r\n--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n'
+ERROR_FRAME_PART = MJPEG_FRAME_HEADER % len(ERROR_FRAME_JPEG) + ERROR_FRAME_JPEG
+STREAM_FAILED_PART = MJPEG_FRAME_HEADER % len(STREAM_FAILED_JPEG) + STREAM_FAILED_JPEG
+
+class StreamingOutput(io.BufferedIOBase):
+    """File-like sink for the MJPEG encoder that keeps only the latest frame"""
+    def __init__(self):
+        self.frame = None
+        # One Event per web client. Replaced rather than mutated, so write()
+        # can iterate it without locking; the lock only orders the writers
+        self._subscribers = frozenset()
+        self._subscribers_lock = threading.Lock()
+
+    def subscribe(self):
+        """Register a client and return the Event set on every new frame"""
+        event = threading.Event()
+        with self._subscribers_lock:
+            self._subscribers = self._subscribers | {event}
+        return event
+
+    def unsubscribe(self, event):
+        """Forget a client registered with subscribe()"""
+        with self._subscribers_lock:
+            self._subscribers = self._subscribers - {event}
+
+    def write(self, buf):
+        # Never blocks on clients: slow ones simply miss intermediate frames
+        self.frame = buf
+        for event in self._subscribers:
+            event.set()
+        return len(buf)
+
+# About a second of H.264 at 30 fps may wait for ffmpeg before frames are dropped
+H264_QUEUE_FRAMES = 30
+
+class H264PipeWriter(io.BufferedIOBase):
+    """File-like sink that hands H.264 to ffmpeg on its own thread, never blocking the encoder"""
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.frames = queue.Queue(maxsize=H264_QUEUE_FRAMES)
+        self.waiting_for_keyframe = False
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def write(self, buf):
+        # With repeat=True every keyframe starts with an SPS NAL unit (type 7)
+        keyframe = buf[:4] == b'\x00\x00\x00\x01' and buf[4] & 0x1f == 7
+        # After a drop the following frames reference missing data, so
+        # skip ahead to the next keyframe
+        if self.waiting_for_keyframe and not keyframe:
+            return len(buf)
+        try:
+            self.frames.put_nowait(buf)
+            self.waiting_for_keyframe = False
+        except queue.Full:
+            # ffmpeg (or the viewer behind it) is behind; drop rather than
+            # stall the encoder, which would hold on to camera buffers
+            self.waiting_for_keyframe = True
+        return len(buf)
+
+    def _write_loop(self):
+        while True:
+            buf = self.frames.get()
+            if buf is None:
+                break
+            try:
+                self.pipe.write(buf)
+                self.pipe.flush()
+            except (OSError, ValueError):
+                break  # ffmpeg has exited
+        # EOF lets ffmpeg flush its last fragment and exit, ending the response
+        try:
+            self.pipe.close()
+        except (OSError, ValueError):
+            pass
+
+    def close(self):
+        """Stop the writer thread and close ffmpeg's stdin once the encoder has stopped"""
+        while True:
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                break
+        self.frames.put(None)
+
 class NetworkMonitor:
+    # Minimal DNS query (ID 0x1234, recursion desired) for the root zone's NS records
+    DNS_PROBE_QUERY = b'\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x02\x00\x01'
+    
     def __init__(self):
         self.is_connected = True
-        self.last_check = datetime.now()
+        self.last_check = time.time()  # Wall clock, only formatted for /network_status
+        self._last_check_ts = time.monotonic()
         self.failed_checks = 0
         self.max_failed_checks = 3
         self.check_interval = 5  # seconds
         
+        # Probe results are reused for a while instead of re-probing per request
+        self.wifi_ttl = 30  # seconds
+        self.internet_ttl = 5  # seconds
+        self.wifi_available = False  # Results of the last probes
+        self._wifi_ts = None
+        self.internet_available = False
+        self._inet_ts = None
+        self.wifi_signal_level = None  # dBm, from the last Wi-Fi check
+        self.wifi_link_quality = None  # Driver-reported link quality, same check
+        self._monitor_thread = None
+        
     def check_internet_connection(self):
         """Check internet connectivity"""
+        now = time.monotonic()
+        if self._inet_ts is not None and now - self._inet_ts < self.internet_ttl:
+            return self.internet_available
+        
         try:
-            # Try to reach Google DNS
-            socket.create_connection(("8.8.8.8", 53), timeout=3)
-            return True
+            # Ask Google DNS for the root name servers over UDP; connect()
+            # fails straight away if there is no route at all
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.settimeout(1)
+                sock.connect(("8.8.8.8", 53))
+                sock.send(self.DNS_PROBE_QUERY)
+                connected = sock.recv(512)[:2] == self.DNS_PROBE_QUERY[:2]
         except OSError:
-            return False
+            connected = False
+        
+        self.internet_available, self._inet_ts = connected, now
+        return connected
     
     def check_wifi_signal(self):
         """Check WiFi signal strength (Linux specific)"""
+        now = time.monotonic()
+        if self._wifi_ts is not None and now - self._wifi_ts < self.wifi_ttl:
+            return self.wifi_available
+        
+        # The kernel lists each associated wireless interface after two header
+        # lines, which is all iwconfig's output was used for
+        has_signal = False
         try:
-            result = subprocess.run(['iwconfig'], capture_output=True, text=True, timeout=5)
-            if 'Signal level' in result.stdout:
-                # Extract signal level (rough check)
-                return True
-            return False
-        except (subprocess.TimeoutExpired, FileNotFoundError):
-            return False
+            with open('/proc/net/wireless') as f:
+                interfaces = f.read().splitlines()[2:]
+            if interfaces:
+                has_signal = True
+                fields = interfaces[0].split()
+                self.wifi_link_quality = float(fields[2].rstrip('.'))
+                self.wifi_signal_level = float(fields[3].rstrip('.'))
+        except (OSError, IndexError, ValueError):
+            pass
+        
+        self.wifi_available, self._wifi_ts = has_signal, now
+        return has_signal
+    
+    def start(self):
+        """Run the checks on a background thread so request handlers never wait on a probe"""
+        if self._monitor_thread is None:
+            self._monitor_thread = threading.Thread(target=self._monitor_loop)
+            self._monitor_thread.daemon = True
+            self._monitor_thread.start()
+    
+    def _monitor_loop(self):
+        while True:
+            self._run_check()
+            time.sleep(self.check_interval)
     
     def is_network_stable(self):
         """Check if network is stable enough for streaming"""
-        now = datetime.now()
+        if self._monitor_thread is not None:
+            return self.is_connected  # Kept current by the background thread
         
         # Only check every few seconds to avoid overhead
-        if (now - self.last_check).seconds < self.check_interval:
+        if time.monotonic() - self._last_check_ts < self.check_interval:
             return self.is_connected
-            
-        self.last_check = now
+        self._run_check()
+        return self.is_connected
+    
+    def _run_check(self):
+        """Probe Wi-Fi and internet once and update the connection state"""
+        self._last_check_ts = time.monotonic()
+        self.last_check = time.time()
         
-        # Check both WiFi and internet
+        # Check WiFi first; without it the internet probe can only time out
         wifi_ok = self.check_wifi_signal()
-        internet_ok = self.check_internet_connection()
+        internet_ok = wifi_ok and self.check_internet_connection()
         
         if wifi_ok and internet_ok:
             self.failed_checks = 0
@@ -153,8 +502,6 @@ class NetworkMonitor:
             self.failed_checks += 1
             if self.failed_checks >= self.max_failed_checks:
                 self.is_connected = False
-                
-        return self.is_connected
 
 class CameraStreamWithLCD:
     def __init__(self):
@@ -163,10 +510,22 @@ class CameraStreamWithLCD:
         self.lcd_streaming = False  # For LCD display
         self.web_streaming = False  # For web clients
         self.lock = threading.Lock()
+        self.encoder = None  # Hardware MJPEG encoder while web streaming
+        self.streaming_output = StreamingOutput()
+        self.frame_cond = threading.Condition()  # Signals a new latest_lores
+        self.latest_lores = None  # Newest 128x128 YUV420 frame for the LCD
+        self.lores_seq = 0  # Bumped with each latest_lores; the ring reuses its arrays
+        self.lcd_stream_name = "main"  # Camera stream the LCD frames come from
+        self._capture_buffers = {}  # (stream, shape) -> reused frame buffers
+        self._current_main_size = None  # Main stream size the camera is configured for
+        self._data_uri_cache = (None, None)  # (JPEG bytes, data URI) of the last encoded frame
         self.lcd = None
+        self.ui_events = queue.Queue()  # Button pins (or None on state change)
         self.setup_lcd()
         self.setup_gpio()
         self.active_clients = 0 # Track active clients for video_feed
+        self.h264_clients = 0  # Of active_clients, those watching /video_feed_h264
+        self._clients_lock = threading.Lock()  # Guards active_clients and h264_clients
         self.network_monitor = NetworkMonitor() # Initialize network monitor
         self.camera_error_count = 0  # Track camera errors
         self.max_camera_errors = 5   # Max errors before giving up
@@ -175,40 +534,79 @@ class CameraStreamWithLCD:
         
     def setup_gpio(self):
         """Sets up GPIO pins for buttons."""
+        if GPIO is None:
+            print("RPi.GPIO not available, buttons disabled")
+            return
+        
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(KEY1_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
         GPIO.setup(KEY2_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
         GPIO.setup(KEY3_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
         
+        # Edge-triggered callbacks instead of polling the pins
+        for pin in (KEY1_PIN, KEY2_PIN, KEY3_PIN):
+            GPIO.add_event_detect(pin, GPIO.FALLING, callback=self._on_button, bouncetime=300)
+        
+    def _on_button(self, channel):
+        """GPIO edge callback: hand the press to the button loop"""
+        if channel == KEY3_PIN:
+            self.lcd_streaming = False  # Stop the LCD loop right away
+        self.ui_events.put(channel)
+        
     def setup_lcd(self):
         """Initialize the LCD display."""
+        # Load the font once rather than on every message
+        try:
+            self.font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf', 12)
+        except IOError:
+            self.font = ImageFont.load_default()
+        self._last_lcd_key = None  # Lines currently shown on the LCD
+        
+        if LCD_1in44 is None:
+            print("LCD driver not available, display disabled")
+            return
+        
         try:
             self.lcd = LCD_1in44.LCD()
             Lcd_ScanDir = LCD_1in44.SCAN_DIR_DFT
             self.lcd.LCD_Init(Lcd_ScanDir)
             self.lcd.LCD_Clear()
+            
+            # One canvas reused by every message instead of a new image each time
+            self._canvas = Image.new("RGB", (self.lcd.width, self.lcd.height), "WHITE")
+            self._draw = ImageDraw.Draw(self._canvas)
         except Exception as e:
             print(f"LCD setup error: {e}")
             self.lcd = None
+            return
+        
+        # Compile the LCD colour conversion now so the first frame isn't delayed;
+        # without an LCD nothing converts lores frames, so skip the JIT cost
+        try:
+            yuv420_to_rgb(np.zeros((192, 128), dtype=np.uint8), 128, 128)
+        except Exception as e:
+            print(f"YUV conversion warm-up error: {e}")
         
     def display_message(self, lines):
         """Displays multi-line messages on the LCD."""
         if not self.lcd:
             return
+        
+        # Skip the render and SPI push if this message is already on screen
+        lcd_key = tuple(lines)
+        if lcd_key == self._last_lcd_key:
+            return
             
         try:
-            image = Image.new("RGB", (self.lcd.width, self.lcd.height), "WHITE")
-            draw = ImageDraw.Draw(image)
-            try:
-                font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf', 12)
-            except IOError:
-                font = ImageFont.load_default()
+            draw = self._draw
+            draw.rectangle([(0, 0), self._canvas.size], fill="WHITE")
             
             y_text = 10
             for line in lines:
-                draw.text((5, y_text), line, font=font, fill="BLACK")
+                draw.text((5, y_text), line, font=self.font, fill="BLACK")
                 y_text += 16
-            self.lcd.LCD_ShowImage(image, 0, 0)
+            self.lcd.LCD_ShowImage(self._canvas, 0, 0)
+            self._last_lcd_key = lcd_key
         except Exception as e:
             print(f"LCD display error: {e}")
         
@@ -218,7 +616,7 @@ class CameraStreamWithLCD:
             return operation_func()
         except Exception as e:
             self.camera_error_count += 1
-            self.last_camera_error = datetime.now()
+            self.last_camera_error = time.monotonic()
             error_msg = str(e)
             
             print(f"Camera error in {operation_name}: {error_msg}")
@@ -260,15 +658,22 @@ class CameraStreamWithLCD:
         try:
             with self.lock:
                 if self.picam2:
+                    # Unpublish first so lock-free readers stop using it
+                    picam2, self.picam2 = self.picam2, None
                     try:
-                        self.picam2.stop()
+                        if self.encoder:
+                            picam2.stop_recording()
+                        else:
+                            picam2.stop()
                     except:
                         pass
                     try:
-                        self.picam2.close()
+                        picam2.close()
                     except:
                         pass
-                    self.picam2 = None
+                    self.encoder = None
+                    self._current_main_size = None
+                    self.streaming_output.frame = None
                     print("Camera object cleaned up")
                     
                 # Small delay to let hardware reset
@@ -277,80 +682,153 @@ class CameraStreamWithLCD:
         except Exception as e:
             print(f"Force cleanup error: {e}")
             
+    def _create_camera_config(self, picam2, web_mode):
+        """Build the Picamera2 configuration for web or LCD-only streaming"""
+        if web_mode:
+            # Higher resolution for web streaming, plus an ISP-scaled
+            # lores stream so the LCD never needs a software resize
+            # YUV420 is half the bytes of RGB and is what the JPEG encoders
+            # consume natively; full-range sYCC so it maps straight onto JFIF
+            config = picam2.create_video_configuration(
+                main={"size": (640, 480), "format": "YUV420"},
+                lores={"size": (128, 128), "format": "YUV420"},
+                colour_space=ColorSpace.Sycc()
+            )
+            self.lcd_stream_name = "lores"
+        else:
+            # LCD-only mode, in the same YUV420 layout as the web-mode lores
+            # stream so the LCD path is identical in both modes
+            config = picam2.create_preview_configuration(
+                main={"size": (128, 128), "format": "YUV420"},
+                colour_space=ColorSpace.Sycc()
+            )
+            self.lcd_stream_name = "main"
+        return config
+        
+    def _start_web_encoder(self):
+        """Let the VideoCore hardware JPEG block produce the web stream"""
+        try:
+            self.encoder = MJPEGEncoder(bitrate=4000000)
+            self.picam2.start_encoder(self.encoder, FileOutput(self.streaming_output))
+        except Exception as e:
+            # The capture thread falls back to encoding with libjpeg-turbo
+            print(f"Hardware MJPEG encoder unavailable, encoding in software: {e}")
+            self.encoder = None
+        
+    def _wait_for_first_frame(self, picam2, max_frames=30):
+        """Return once auto-exposure has settled, capped at max_frames frames"""
+        for _ in range(max_frames):
+            metadata = picam2.capture_metadata()
+            if metadata.get("AeLocked"):
+                break
+        
+    def _open_camera(self, web_mode):
+        """Create, configure and start the camera; caller holds self.lock"""
+        if Picamera2 is None:
+            print("picamera2 not available, cannot start camera")
+            return False
+        
+        # Check if we're in error recovery mode
+        if (self.last_camera_error is not None and
+            time.monotonic() - self.last_camera_error < self.camera_recovery_delay):
+            print("Camera in recovery mode, skipping start")
+            return False
+            
+        # Only published once running: lock-free readers and the warm-camera
+        # checks treat a non-None self.picam2 as a started camera
+        picam2 = Picamera2()
+        try:
+            # Choose resolution based on what's needed
+            config = self._create_camera_config(picam2, web_mode)
+            picam2.configure(config)
+            picam2.start()
+            self._wait_for_first_frame(picam2)  # Allow camera to warm up
+        except Exception:
+            try:
+                picam2.close()
+            except Exception as e:
+                print(f"Error closing camera: {e}")
+            raise
+        self.picam2 = picam2
+        self._current_main_size = config["main"]["size"]
+        
+        # Reset error count on successful start
+        self.camera_error_count = 0
+        print("Camera started successfully")
+        return True
+        
     def start_camera(self):
         """Initialize and start the camera with enhanced error handling"""
         def _start_camera():
-            if self.picam2 is None:
-                # Check if we're in error recovery mode
-                if (self.last_camera_error and 
-                    (datetime.now() - self.last_camera_error).seconds < self.camera_recovery_delay):
-                    print("Camera in recovery mode, skipping start")
+            with self.lock:
+                if self.picam2 is None and not self._open_camera(self.web_streaming):
                     return False
-                    
-                self.picam2 = Picamera2()
-                
-                # Choose resolution based on what's needed
-                if self.web_streaming:
-                    # Higher resolution for web streaming
-                    config = self.picam2.create_preview_configuration(
-                        main={"size": (640, 480)}
-                    )
-                else:
-                    # LCD-only mode
-                    config = self.picam2.create_preview_configuration(
-                        main={"size": (128, 128)}
-                    )
-                    
-                self.picam2.configure(config)
-                self.picam2.start()
-                time.sleep(2)  # Allow camera to warm up
-                
-                # Reset error count on successful start
-                self.camera_error_count = 0
-                print("Camera started successfully")
+                # Also covers a camera left warm by /capture, which has no encoder
+                if self.web_streaming and self.encoder is None:
+                    self._start_web_encoder()
                 return True
-            return True
             
         return self.safe_camera_operation(_start_camera, "camera start")
+        
+    def ensure_camera(self):
+        """Return the running camera, starting it in web mode and leaving it warm if needed"""
+        with self.lock:
+            if self.picam2 is None and not self._open_camera(True):
+                return None
+            return self.picam2
             
     def restart_camera_if_needed(self, need_web_res=False):
         """Restart camera with different resolution if needed"""
-        current_size = None
-        if self.picam2:
-            current_size = (640, 480) if need_web_res else (128, 128)
-            
-        need_restart = False
-        if need_web_res and current_size == (128, 128):
-            need_restart = True
-        elif not need_web_res and current_size == (640, 480):
-            need_restart = True
+        target_size = (640, 480) if need_web_res else (128, 128)
+        need_restart = self.picam2 is not None and self._current_main_size != target_size
             
         if need_restart:
-            print(f"Restarting camera for {'web' if need_web_res else 'LCD-only'} resolution")
-            self.stop_camera()
-            return self.start_camera()
+            print(f"Switching camera to {'web' if need_web_res else 'LCD-only'} resolution")
+            
+            def _switch_mode():
+                # switch_mode keeps the sensor running, unlike a full stop/start
+                with self.lock:
+                    if self.encoder:
+                        self.picam2.stop_encoder()
+                        self.encoder = None
+                    config = self._create_camera_config(self.picam2, need_web_res)
+                    self.picam2.switch_mode(config)
+                    self._current_main_size = config["main"]["size"]
+                    if need_web_res:
+                        self._start_web_encoder()
+                    self._wait_for_first_frame(self.picam2)
+                return True
+            
+            return self.safe_camera_operation(_switch_mode, "camera mode switch")
         return True
                 
     def stop_camera(self):
         """Stop the camera with enhanced cleanup"""
         with self.lock:
             if self.picam2:
+                # Unpublish first so lock-free readers stop using it
+                picam2, self.picam2 = self.picam2, None
                 try:
-                    self.picam2.stop()
+                    if self.encoder:
+                        picam2.stop_recording()
+                    else:
+                        picam2.stop()
                 except Exception as e:
                     print(f"Error stopping camera: {e}")
                 try:
-                    self.picam2.close()
+                    picam2.close()
                 except Exception as e:
                     print(f"Error closing camera: {e}")
-                self.picam2 = None
+                self.encoder = None
+                self._current_main_size = None
+                self.streaming_output.frame = None
                 print("Camera stopped and cleaned up")
                 
     def start_streaming(self):
         """Start both LCD and web streaming with error handling"""
         try:
+            # The message stays up while the camera starts; no need to hold it longer
             self.display_message(["Starting Stream...", "Initializing...", "Please wait..."])
-            time.sleep(1)
             
             # Set streaming flags first
             self.streaming = True
@@ -367,10 +845,16 @@ class CameraStreamWithLCD:
             
             self.display_message(["Stream Active!", "Web: Available", "LCD: Active", "Press KEY3 to stop"])
             
+            # Single producer thread feeding every frame consumer
+            capture_thread = threading.Thread(target=self._capture_loop)
+            capture_thread.daemon = True
+            capture_thread.start()
+            
             # Start LCD streaming in a separate thread
-            lcd_thread = threading.Thread(target=self.lcd_stream_loop)
-            lcd_thread.daemon = True
-            lcd_thread.start()
+            if self.lcd:
+                lcd_thread = threading.Thread(target=self.lcd_stream_loop)
+                lcd_thread.daemon = True
+                lcd_thread.start()
             
             return True
             
@@ -382,19 +866,100 @@ class CameraStreamWithLCD:
             self.web_streaming = False
             return False
         
+    def _copy_stream(self, request, name):
+        """Copy one stream of a capture request into a reused buffer"""
+        with MappedArray(request, name) as mapped:
+            source = mapped.array
+            ring = self._capture_buffers.get((name, source.shape))
+            if ring is None:
+                # A small ring so consumers still reading a frame aren't overwritten
+                ring = [np.empty_like(source) for _ in range(3)]
+                self._capture_buffers[(name, source.shape)] = ring
+            target = ring.pop(0)
+            ring.append(target)
+            np.copyto(target, source)
+        return target
+        
+    def capture_jpeg(self, picam2, quality=90):
+        """Capture one main-stream frame and JPEG-encode it straight from the camera buffer"""
+        width, height = picam2.stream_configuration("main")["size"]
+        request = picam2.capture_request()
+        try:
+            with MappedArray(request, "main") as mapped:
+                jpeg = encode_jpeg(mapped.array, quality=quality, width=width, height=height)
+            return jpeg, (width, height)
+        finally:
+            request.release()
+        
+    def capture_still(self, quality=90):
+        """Newest JPEG and its size for /capture, or None if the camera is unavailable"""
+        # While web streaming, the encoder has already produced this JPEG
+        jpeg = self.latest_web_jpeg()
+        if jpeg is not None:
+            return jpeg, self._current_main_size
+        
+        # The camera stays running after the first capture, so later ones
+        # skip sensor start-up and exposure settling
+        picam2 = self.ensure_camera()
+        if picam2 is None:
+            return None
+        return self.capture_jpeg(picam2, quality=quality)
+        
+    def _capture_loop(self):
+        """Capture each frame once and publish it to all frame consumers"""
+        pin_to_cores(CAPTURE_CORES)
+        # Without the LCD HAT nothing consumes the lores frames
+        lcd_attached = self.lcd is not None
+        
+        def _capture_frame():
+            # self.lock only guards the camera lifecycle; Picamera2 serialises
+            # captures itself, and stop_camera clears self.picam2 before stopping
+            picam2 = self.picam2
+            if picam2 is None:
+                return None
+            # Without the hardware encoder the web JPEG is produced here too
+            software_jpeg = self.web_streaming and self.encoder is None
+            request = picam2.capture_request()
+            try:
+                lcd_frame = self._copy_stream(request, self.lcd_stream_name) if lcd_attached else None
+                web_frame = self._copy_stream(request, "main") if software_jpeg else None
+            finally:
+                # Hand the DMA buffer straight back to the camera's small pool
+                request.release()
+            return lcd_frame, web_frame
+        
+        while self.streaming and ((self.lcd_streaming and lcd_attached) or
+                                  (self.web_streaming and self.encoder is None)):
+            frames = self.safe_camera_operation(_capture_frame, "frame capture")
+            if frames is None:
+                time.sleep(1)  # Wait longer on error
+                continue
+            frame, web_frame = frames
+            
+            if web_frame is not None:
+                width, height = self._current_main_size
+                self.streaming_output.write(encode_jpeg(web_frame, quality=85,
+                                                        width=width, height=height))
+            
+            if frame is None:
+                continue
+            
+            # Colour conversion happens on the LCD thread, so this one can go
+            # straight back to waiting on the next camera buffer
+            with self.frame_cond:
+                self.latest_lores = frame
+                self.lores_seq += 1
+                self.frame_cond.notify_all()
+        
     def lcd_stream_loop(self):
         """Stream video to LCD display with enhanced error handling"""
+        pin_to_cores(LCD_CORES)
         consecutive_errors = 0
         max_consecutive_errors = 10
+        last_seq = self.lores_seq
         
         try:
             while self.lcd_streaming and self.streaming:
-                # Check for stop button
-                if not GPIO.input(KEY3_PIN):
-                    print("KEY3 pressed, stopping streams.")
-                    self.stop_streaming()
-                    break
-                
                 # Skip if too many consecutive errors
                 if consecutive_errors >= max_consecutive_errors:
                     print("Too many LCD streaming errors, stopping LCD stream")
@@ -402,48 +967,71 @@ class CameraStreamWithLCD:
                     self.display_message(["LCD Error!", "Too many fails", "Web still active", "Check hardware"])
                     break
                 
-                def _capture_and_display():
-                    nonlocal consecutive_errors
-                    
-                    with self.lock:
-                        if self.picam2:
-                            # Capture frame with timeout protection
-                            frame = self.picam2.capture_array()
-                            
-                            # Convert numpy array to PIL Image
-                            image = Image.fromarray(frame)
-                            
-                            # Only resize if not already 128x128
-                            if image.size != (128, 128):
-                                try:
-                                    image = image.resize((128, 128), Image.Resampling.LANCZOS)
-                                except AttributeError:
-                                    try:
-                                        image = image.resize((128, 128), Image.LANCZOS)
-                                    except AttributeError:
-                                        image = image.resize((128, 128), Image.ANTIALIAS)
-                            
-                            # Display on LCD
-                            if self.lcd:
-                                self.lcd.LCD_ShowImage(image, 0, 0)
-                            
-                            consecutive_errors = 0  # Reset on success
-                            return True
-                    return False
+                # Wait for the capture thread to publish a newer frame; compare
+                # sequence numbers, as the capture ring hands out the same arrays
+                with self.frame_cond:
+                    self.frame_cond.wait_for(lambda: self.lores_seq != last_seq, timeout=1.0)
+                    frame = self.latest_lores
+                    seq = self.lores_seq
                 
-                # Execute capture with error handling
-                success = self.safe_camera_operation(_capture_and_display, "LCD capture")
+                if frame is None or seq == last_seq:
+                    consecutive_errors += 1
+                    continue
+                last_seq = seq
                 
-                if not success:
+                try:
+                    # The ISP already scaled the frame to the LCD size
+                    image = Image.fromarray(yuv420_to_rgb(frame, 128, 128))
+                    
+                    # Display on LCD
+                    if self.lcd:
+                        self.lcd.LCD_ShowImage(image, 0, 0)
+                        self._last_lcd_key = None  # Screen no longer shows a message
+                    
+                    consecutive_errors = 0  # Reset on success
+                except Exception as e:
+                    print(f"LCD display error: {e}")
                     consecutive_errors += 1
                     time.sleep(1)  # Wait longer on error
-                else:
-                    time.sleep(0.05)  # Normal 20 FPS
                     
         except Exception as e:
             print(f"LCD streaming loop error: {e}")
             self.lcd_streaming = False
         
+    def latest_web_jpeg(self):
+        """Newest JPEG from the web stream's encoder, or None when not web streaming"""
+        if self.streaming and self.web_streaming:
+            return self.streaming_output.frame
+        return None
+        
+    def frame_data_uri(self, frame_bytes):
+        """Base64 data URI for a web frame, encoded once however many clients send it"""
+        cached_frame, data_uri = self._data_uri_cache
+        if cached_frame is not frame_bytes:
+            data_uri = jpeg_data_uri(frame_bytes)
+            # Swapped in as one tuple so concurrent readers never see a mismatched pair
+            self._data_uri_cache = (frame_bytes, data_uri)
+        return data_uri
+        
+    def add_client(self, h264=False):
+        """Count a new stream viewer, or return False if the limit is reached"""
+        with self._clients_lock:
+            if self.active_clients >= MAX_STREAM_CLIENTS:
+                return False
+            if h264 and self.h264_clients >= MAX_H264_CLIENTS:
+                return False
+            self.active_clients += 1
+            if h264:
+                self.h264_clients += 1
+            return True
+        
+    def remove_client(self, h264=False):
+        """Count a stream viewer as gone"""
+        with self._clients_lock:
+            self.active_clients = max(0, self.active_clients - 1)
+            if h264:
+                self.h264_clients = max(0, self.h264_clients - 1)
+        
     def stop_streaming(self):
         """Stop all streaming with cleanup"""
         print("Stopping all streaming...")
@@ -456,9 +1044,8 @@ class CameraStreamWithLCD:
         
         self.stop_camera()
         
-        if self.lcd:
-            self.display_message(["Stream Stopped", "Press KEY1 to start", "Press KEY2 to exit"])
-        
+        # The button loop draws the idle menu once on this transition
+        self.ui_events.put(None)
         print("All streaming stopped")
 
     def generate_frames(self):
@@ -466,91 +1053,104 @@ class CameraStreamWithLCD:
         frame_count = 0
         consecutive_errors = 0
         max_consecutive_errors = 20
+        output = self.streaming_output
+        frame_ready = output.subscribe()
+        last_frame = None
         
-        while self.web_streaming and self.streaming:
-            # Stop if too many consecutive errors
-            if consecutive_errors >= max_consecutive_errors:
-                print("Too many web streaming errors, stopping web stream")
-                self.web_streaming = False
-                # Generate error frame and break
-                error_image = Image.new('RGB', (640, 480), color='red')
-                draw = ImageDraw.Draw(error_image)
-                draw.text((200, 220), "Web Stream Failed:", fill='white')
-                draw.text((200, 240), "Too many errors", fill='white')
-                draw.text((200, 260), "Check camera hardware", fill='white')
+        try:
+            while self.web_streaming and self.streaming:
+                # Stop if too many consecutive errors
+                if consecutive_errors >= max_consecutive_errors:
+                    print("Too many web streaming errors, stopping web stream")
+                    self.web_streaming = False
+                    # Send the error frame and break
+                    yield STREAM_FAILED_PART
+                    break
                 
-                img_io = io.BytesIO()
-                error_image.save(img_io, 'JPEG')
-                img_io.seek(0)
-                error_bytes = img_io.read()
+                # Wait for the producer's signal, then take whatever frame is
+                # newest; frames published while we were sending are skipped
+                if frame_ready.wait(timeout=2.0):
+                    frame_ready.clear()
+                    frame_bytes = output.frame
+                    if frame_bytes is last_frame and frame_bytes is not None:
+                        # Already sent the newest frame; not an error, just wait again
+                        continue
+                else:
+                    frame_bytes = None
                 
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + error_bytes + b'\r\n')
-                break
-            
-            def _capture_web_frame():
-                nonlocal frame_count, consecutive_errors
+                if frame_bytes is not None:
+                    last_frame = frame_bytes
+                    frame_count += 1
+                    consecutive_errors = 0  # Reset on success
+                    
+                    if frame_count % 30 == 0:  # Log every 30 frames
+                        print(f"Web streaming: frame {frame_count}, {len(frame_bytes)} bytes")
+                    
+                    # Yielded as separate chunks: the server copies the frame into
+                    # its send buffer anyway, so joining first only adds a copy
+                    yield MJPEG_FRAME_HEADER % len(frame_bytes)
+                    yield frame_bytes
+                else:
+                    consecutive_errors += 1
+                    print(f"Web frame capture failed, consecutive errors: {consecutive_errors}")
+                    
+                    yield ERROR_FRAME_PART
+                    time.sleep(1)  # Wait longer on error
+        finally:
+            output.unsubscribe(frame_ready)
                 
-                with self.lock:
-                    if self.picam2:
-                        # Capture frame as numpy array
-                        frame = self.picam2.capture_array()
-                        
-                        # Convert numpy array to PIL Image
-                        image = Image.fromarray(frame)
-                        
-                        # Convert RGBA to RGB if needed
-                        if image.mode == 'RGBA':
-                            rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-                            rgb_image.paste(image, mask=image.split()[-1])
-                            image = rgb_image
-                        elif image.mode != 'RGB':
-                            image = image.convert('RGB')
-                        
-                        # Convert to JPEG using PIL
-                        img_io = io.BytesIO()
-                        image.save(img_io, format='JPEG', quality=85)
-                        img_io.seek(0)
-                        frame_bytes = img_io.read()
-                        
-                        frame_count += 1
-                        consecutive_errors = 0  # Reset on success
-                        
-                        if frame_count % 30 == 0:  # Log every 30 frames
-                            print(f"Web streaming: frame {frame_count}, size: {image.size}, mode: {image.mode}")
-                        
-                        return frame_bytes
-                return None
-            
-            # Execute capture with error handling
-            frame_bytes = self.safe_camera_operation(_capture_web_frame, "web frame capture")
+    def generate_h264(self):
+        """Generate a fragmented MP4 (H.264) stream for low-bandwidth viewers"""
+        encoder = None
+        ffmpeg = None
+        writer = None
+        encoder_started = False
+        
+        try:
+            with self.lock:
+                if not self.picam2:
+                    return
+                # ffmpeg only remuxes the hardware H.264 into MP4 fragments, no re-encode
+                try:
+                    ffmpeg = subprocess.Popen(
+                        ['ffmpeg', '-loglevel', 'error', '-f', 'h264', '-i', 'pipe:0',
+                         '-c', 'copy', '-f', 'mp4',
+                         '-movflags', 'frag_keyframe+empty_moov+default_base_moof', 'pipe:1'],
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                except OSError as e:
+                    print(f"Could not start ffmpeg for H.264 streaming: {e}")
+                    return
+                writer = H264PipeWriter(ffmpeg.stdin)
+                encoder = H264Encoder(bitrate=1000000, repeat=True, iperiod=30)
+                self.picam2.start_encoder(encoder, FileOutput(writer))
+                encoder_started = True
             
-            if frame_bytes:
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-                time.sleep(0.033)  # ~30 FPS for web
-            else:
-                consecutive_errors += 1
-                print(f"Web frame capture failed, consecutive errors: {consecutive_errors}")
-                
-                # Generate error frame
-                error_image = Image.new('RGB', (640, 480), color='orange')
-                draw = ImageDraw.Draw(error_image)
-                draw.text((200, 200), "Frame Error", fill='black')
-                draw.text((200, 220), f"Consecutive: {consecutive_errors}", fill='black')
-                draw.text((200, 240), "Attempting recovery...", fill='black')
-                
-                img_io = io.BytesIO()
-                error_image.save(img_io, 'JPEG')
-                img_io.seek(0)
-                error_bytes = img_io.read()
-                
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + error_bytes + b'\r\n')
-                time.sleep(1)  # Wait longer on error
+            # stop_streaming stops the encoder without telling this generator,
+            # so wake up every second to notice rather than waiting on ffmpeg
+            stdout = ffmpeg.stdout.fileno()
+            while self.web_streaming and self.streaming:
+                ready, _, _ = select.select([stdout], [], [], 1.0)
+                if not ready:
+                    continue
+                chunk = os.read(stdout, 65536)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            with self.lock:
+                if encoder_started and self.picam2:
+                    try:
+                        self.picam2.stop_encoder(encoder)
+                    except Exception as e:
+                        print(f"Error stopping H.264 encoder: {e}")
+            if writer is not None:
+                writer.close()
+            if ffmpeg is not None:
+                ffmpeg.kill()
+                ffmpeg.wait()
                 
     def button_monitor_loop(self):
-        """Monitor button presses"""
+        """Handle button presses delivered by the GPIO edge callbacks"""
         while True:
             try:
                 if not self.streaming:
@@ -563,13 +1163,14 @@ class CameraStreamWithLCD:
                     ]
                     self.display_message(welcome_lines)
                 
-                # Check button presses
-                if not GPIO.input(KEY1_PIN) and not self.streaming:
+                # Sleep until a button is pressed or the streaming state changes
+                key = self.ui_events.get()
+                
+                if key == KEY1_PIN and not self.streaming:
                     print("KEY1 pressed, starting stream.")
                     self.start_streaming()
-                    time.sleep(0.5)  # Debounce
                     
-                if not GPIO.input(KEY2_PIN):
+                elif key == KEY2_PIN:
                     print("KEY2 pressed, exiting program.")
                     self.display_message(["Goodbye!", "Shutting down..."])
                     time.sleep(1)
@@ -578,7 +1179,9 @@ class CameraStreamWithLCD:
                     GPIO.cleanup()
                     exit(0)
                     
-                time.sleep(0.1)  # Polling delay
+                elif key == KEY3_PIN and self.streaming:
+                    print("KEY3 pressed, stopping streams.")
+                    self.stop_streaming()
                 
             except Exception as e:
                 print(f"Button monitor error: {e}")
@@ -592,13 +1195,31 @@ def index():
     """Main page with video stream"""
     return render_template('index.html')
 
+def stream_limit_response(max_clients=MAX_STREAM_CLIENTS):
+    """Response for a stream viewer turned away at the client limit"""
+    return jsonify({
+        "status": "error",
+        "message": "Too many stream clients",
+        "max_clients": max_clients
+    }), 503
+
+def counted_stream(chunks, h264=False):
+    """Pass a stream's chunks through, freeing the viewer's client slot when it ends"""
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        camera_stream.remove_client(h264)
+
 @app.route('/video_feed')
 def video_feed():
     """Video streaming route with enhanced CORS"""
     if camera_stream.streaming and camera_stream.web_streaming:
+        # Track active clients, turning away any beyond the limit
+        if not camera_stream.add_client():
+            return stream_limit_response()
+        
         try:
-            # Track active clients
-            camera_stream.active_clients = getattr(camera_stream, 'active_clients', 0) + 1
             print(f"New client connected. Active clients: {camera_stream.active_clients}")
             
             def generate_with_cleanup():
@@ -611,7 +1232,7 @@ def video_feed():
                     print(f"Streaming error for client: {e}")
                 finally:
                     # Decrement client counter when connection closes
-                    camera_stream.active_clients = max(0, getattr(camera_stream, 'active_clients', 1) - 1)
+                    camera_stream.remove_client()
                     print(f"Client disconnected. Active clients: {camera_stream.active_clients}")
             
             response = Response(generate_with_cleanup(),
@@ -626,39 +1247,44 @@ def video_feed():
             
         except Exception as e:
             # Cleanup on error
-            camera_stream.active_clients = max(0, getattr(camera_stream, 'active_clients', 1) - 1)
+            camera_stream.remove_client()
             print(f"Error setting up stream for client: {e}")
             # Return error image
-            error_image = Image.new('RGB', (640, 480), (255, 0, 0))  # Red background
-            draw = ImageDraw.Draw(error_image)
-            draw.text((200, 220), f"Streaming Error:", fill=(255, 255, 255))  # White text
-            draw.text((200, 240), str(e)[:50], fill=(255, 255, 255))
-            
-            img_io = io.BytesIO()
-            error_image.save(img_io, format='JPEG', quality=85)
-            img_io.seek(0)
+            error_frame = render_error_jpeg(
+                (((200, 220), "Streaming Error:"), ((200, 240), str(e)[:50])),
+                (255, 0, 0), (255, 255, 255))
             
-            response = Response(img_io.read(), mimetype='image/jpeg')
+            response = Response(error_frame, mimetype='image/jpeg')
             return response
     else:
         # Return a placeholder image when not streaming
-        placeholder = Image.new('RGB', (640, 480), (0, 0, 0))  # Black background
-        draw = ImageDraw.Draw(placeholder)
         if not camera_stream.streaming:
-            draw.text((250, 220), "Camera Stream Not Started", fill=(255, 255, 255))  # White text
-            draw.text((280, 240), "Press KEY1 to start", fill=(255, 255, 255))
+            placeholder = PLACEHOLDER_NO_STREAM_JPEG
         elif not camera_stream.web_streaming:
-            draw.text((250, 220), "Web Streaming Disabled", fill=(255, 255, 255))
+            placeholder = PLACEHOLDER_WEB_DISABLED_JPEG
         else:
-            draw.text((250, 220), "Camera Not Active", fill=(255, 255, 255))
+            placeholder = NO_CAMERA_JPEG
         
-        img_io = io.BytesIO()
-        placeholder.save(img_io, format='JPEG', quality=85)
-        img_io.seek(0)
-        
-        response = Response(img_io.read(), mimetype='image/jpeg')
+        response = Response(placeholder, mimetype='image/jpeg')
         return response
 
+@app.route('/video_feed_h264')
+def video_feed_h264():
+    """Low-bandwidth H.264 stream as fragmented MP4"""
+    if not (camera_stream.streaming and camera_stream.web_streaming):
+        return jsonify({"status": "error", "message": "Stream not started"}), 503
+    if shutil.which('ffmpeg') is None:
+        return jsonify({"status": "error", "message": "ffmpeg is not installed"}), 503
+    
+    # Each viewer holds a server thread, an ffmpeg process and an encoder
+    if not camera_stream.add_client(h264=True):
+        return stream_limit_response(MAX_H264_CLIENTS)
+    
+    response = Response(counted_stream(camera_stream.generate_h264(), h264=True), mimetype='video/mp4')
+    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @app.route('/start_stream', methods=['POST'])
 def start_stream():
     """API endpoint to start streaming"""
@@ -678,33 +1304,39 @@ def stop_stream():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)})
 
+STATUS_FIELDS = ("streaming", "lcd_streaming", "web_streaming", "camera_active", "camera_info",
+                 "camera_object_exists", "network_stable", "active_clients", "network_failed_checks")
+
+@functools.lru_cache(maxsize=8)
+def status_body(state):
+    """Serialise a /status snapshot, reusing the bytes while nothing has changed"""
+    payload = dict(zip(STATUS_FIELDS, state))
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload).encode()
+
 @app.route('/status')
 def status():
     """Get streaming and network status with enhanced info"""
-    camera_active = False
-    camera_info = "No camera"
-    
-    # Better camera state detection
-    if camera_stream.picam2 is not None:
-        try:
-            # Try to get camera info to verify it's actually working
-            camera_active = True
-            camera_info = "Active"
-        except Exception as e:
-            camera_info = f"Error: {str(e)}"
-            camera_active = False
+    camera_active = camera_stream.picam2 is not None
+    camera_info = "Active" if camera_active else "No camera"
     
-    return jsonify({
-        "streaming": camera_stream.streaming,
-        "lcd_streaming": camera_stream.lcd_streaming,
-        "web_streaming": camera_stream.web_streaming,
-        "camera_active": camera_active,
-        "camera_info": camera_info,
-        "camera_object_exists": camera_stream.picam2 is not None,
-        "network_stable": camera_stream.network_monitor.is_network_stable(),
-        "active_clients": getattr(camera_stream, 'active_clients', 0),
-        "network_failed_checks": camera_stream.network_monitor.failed_checks
-    })
+    # Polled continuously by the web UI; the state rarely changes between
+    # polls, and browsers may reuse a response for a second
+    body = status_body((
+        camera_stream.streaming,
+        camera_stream.lcd_streaming,
+        camera_stream.web_streaming,
+        camera_active,
+        camera_info,
+        camera_active,
+        camera_stream.network_monitor.is_network_stable(),
+        camera_stream.active_clients,
+        camera_stream.network_monitor.failed_checks
+    ))
+    response = Response(body, mimetype='application/json')
+    response.headers['Cache-Control'] = 'max-age=1'
+    return response
 
 @app.route('/network_status')
 def network_status():
@@ -713,10 +1345,12 @@ def network_status():
         "network_stable": camera_stream.network_monitor.is_network_stable(),
         "failed_checks": camera_stream.network_monitor.failed_checks,
         "max_failed_checks": camera_stream.network_monitor.max_failed_checks,
-        "last_check": camera_stream.network_monitor.last_check.isoformat(),
+        "last_check": datetime.fromtimestamp(camera_stream.network_monitor.last_check).isoformat(),
         "check_interval": camera_stream.network_monitor.check_interval,
-        "wifi_available": camera_stream.network_monitor.check_wifi_signal(),
-        "internet_available": camera_stream.network_monitor.check_internet_connection()
+        "wifi_available": camera_stream.network_monitor.wifi_available,
+        "wifi_signal_level": camera_stream.network_monitor.wifi_signal_level,
+        "wifi_link_quality": camera_stream.network_monitor.wifi_link_quality,
+        "internet_available": camera_stream.network_monitor.internet_available
     })
 
 @app.route('/debug_info')
@@ -737,76 +1371,31 @@ def debug_info():
         }
     }
     
-    # Try to get frame info if camera exists
-    if camera_stream.picam2 is not None:
-        try:
-            with camera_stream.lock:
-                frame = camera_stream.picam2.capture_array()
-                info["last_frame"] = {
-                    "shape": frame.shape if frame is not None else "None",
-                    "dtype": str(frame.dtype) if frame is not None else "None"
-                }
-        except Exception as e:
-            info["last_frame"] = {"error": str(e)}
+    # Report the frame the capture thread last published rather than capturing
+    # one here, which would stall the streams for a frame on every request
+    frame = camera_stream.latest_lores
+    info["last_frame"] = {
+        "shape": frame.shape if frame is not None else "None",
+        "dtype": str(frame.dtype) if frame is not None else "None"
+    }
+    # Without an LCD there are no lores frames, so report the web stream too
+    web_frame = camera_stream.streaming_output.frame
+    info["last_web_frame"] = {
+        "bytes": len(web_frame) if web_frame is not None else "None",
+        "encoder": "hardware" if camera_stream.encoder is not None else "software"
+    }
     
     return jsonify(info)
 
 @app.route('/capture')
 def capture():
     """Capture a single frame from the camera and return as JPEG"""
-    temp_camera = False  # Initialize at the start
     try:
-        def _do_capture():
-            nonlocal temp_camera
-            
-            # Check if camera is available
-            if not camera_stream.streaming or camera_stream.picam2 is None:
-                # If not streaming, try to start camera temporarily for capture
-                if camera_stream.picam2 is None:
-                    temp_camera = True
-                    camera_stream.picam2 = Picamera2()
-                    # Use web resolution for captures
-                    config = camera_stream.picam2.create_preview_configuration(
-                        main={"size": (640, 480)}
-                    )
-                    camera_stream.picam2.configure(config)
-                    camera_stream.picam2.start()
-                    time.sleep(1)  # Allow camera to stabilize
-            
-            with camera_stream.lock:
-                if camera_stream.picam2:
-                    # Capture frame as numpy array
-                    frame = camera_stream.picam2.capture_array()
-                    
-                    # Convert numpy array to PIL Image
-                    image = Image.fromarray(frame)
-                    
-                    # Convert RGBA to RGB if needed (JPEG doesn't support transparency)
-                    if image.mode == 'RGBA':
-                        rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-                        rgb_image.paste(image, mask=image.split()[-1])
-                        image = rgb_image
-                    elif image.mode != 'RGB':
-                        image = image.convert('RGB')
-                    
-                    # Convert to JPEG
-                    img_io = io.BytesIO()
-                    image.save(img_io, format='JPEG', quality=90)
-                    img_io.seek(0)
-                    frame_bytes = img_io.read()
-                    
-                    # Clean up temporary camera if we started it
-                    if temp_camera:
-                        camera_stream.picam2.stop()
-                        camera_stream.picam2 = None
-                    
-                    return frame_bytes
-            return None
-        
         # Use safe camera operation
-        frame_bytes = camera_stream.safe_camera_operation(_do_capture, "single frame capture")
+        result = camera_stream.safe_camera_operation(camera_stream.capture_still, "single frame capture")
         
-        if frame_bytes:
+        if result:
+            frame_bytes, _ = result
             # Return the image with proper headers
             response = Response(frame_bytes, mimetype='image/jpeg')
             response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
@@ -816,106 +1405,39 @@ def capture():
             return response
         else:
             # Return error image if camera not available
-            error_image = Image.new('RGB', (640, 480), (255, 0, 0))
-            draw = ImageDraw.Draw(error_image)
-            draw.text((200, 220), "Camera Not Available", fill=(255, 255, 255))
-            draw.text((200, 240), "Check camera status", fill=(255, 255, 255))
-            
-            img_io = io.BytesIO()
-            error_image.save(img_io, format='JPEG', quality=85)
-            img_io.seek(0)
-            
-            response = Response(img_io.read(), mimetype='image/jpeg')
+            response = Response(CAPTURE_UNAVAILABLE_JPEG, mimetype='image/jpeg')
             response.status_code = 503  # Service Unavailable
             return response
                 
     except Exception as e:
         print(f"Capture error: {e}")
-        # Clean up temporary camera on error if we started it
-        if temp_camera and camera_stream.picam2:
-            try:
-                camera_stream.picam2.stop()
-                camera_stream.picam2 = None
-            except:
-                pass
         
         # Return error image
-        error_image = Image.new('RGB', (640, 480), (255, 100, 100))
-        draw = ImageDraw.Draw(error_image)
-        draw.text((200, 200), "Capture Failed", fill=(255, 255, 255))
-        draw.text((200, 220), f"Error: {str(e)[:30]}", fill=(255, 255, 255))
-        draw.text((200, 240), "Try again later", fill=(255, 255, 255))
-        
-        img_io = io.BytesIO()
-        error_image.save(img_io, format='JPEG', quality=85)
-        img_io.seek(0)
+        error_frame = render_error_jpeg(
+            (((200, 200), "Capture Failed"), ((200, 220), f"Error: {str(e)[:30]}"),
+             ((200, 240), "Try again later")),
+            (255, 100, 100), (255, 255, 255))
         
-        response = Response(img_io.read(), mimetype='image/jpeg')
+        response = Response(error_frame, mimetype='image/jpeg')
         response.status_code = 500  # Internal Server Error
         return response
 
 @app.route('/capture_base64')
 def capture_base64():
     """Capture a single frame and return as base64 encoded JSON"""
-    temp_camera = False  # Initialize at the start
     try:
-        def _do_capture_base64():
-            nonlocal temp_camera
-            
-            # Check if camera is available
-            if not camera_stream.streaming or camera_stream.picam2 is None:
-                # If not streaming, try to start camera temporarily for capture
-                if camera_stream.picam2 is None:
-                    temp_camera = True
-                    camera_stream.picam2 = Picamera2()
-                    config = camera_stream.picam2.create_preview_configuration(
-                        main={"size": (640, 480)}
-                    )
-                    camera_stream.picam2.configure(config)
-                    camera_stream.picam2.start()
-                    time.sleep(1)
-            
-            with camera_stream.lock:
-                if camera_stream.picam2:
-                    # Capture frame
-                    frame = camera_stream.picam2.capture_array()
-                    image = Image.fromarray(frame)
-                    
-                    # Convert to RGB if needed
-                    if image.mode == 'RGBA':
-                        rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-                        rgb_image.paste(image, mask=image.split()[-1])
-                        image = rgb_image
-                    elif image.mode != 'RGB':
-                        image = image.convert('RGB')
-                    
-                    # Convert to base64
-                    img_io = io.BytesIO()
-                    image.save(img_io, format='JPEG', quality=90)
-                    img_io.seek(0)
-                    
-                    import base64
-                    img_base64 = base64.b64encode(img_io.read()).decode('utf-8')
-                    
-                    # Clean up temporary camera if we started it
-                    if temp_camera:
-                        camera_stream.picam2.stop()
-                        camera_stream.picam2 = None
-                    
-                    return {
-                        "status": "success",
-                        "image": f"data:image/jpeg;base64,{img_base64}",
-                        "timestamp": time.time(),
-                        "size": image.size,
-                        "format": "JPEG"
-                    }
-            return None
-        
         # Use safe camera operation
-        result = camera_stream.safe_camera_operation(_do_capture_base64, "base64 capture")
+        result = camera_stream.safe_camera_operation(camera_stream.capture_still, "base64 capture")
         
         if result:
-            return jsonify(result)
+            jpeg_bytes, size = result
+            return jsonify({
+                "status": "success",
+                "image": camera_stream.frame_data_uri(jpeg_bytes),
+                "timestamp": time.time(),
+                "size": size,
+                "format": "JPEG"
+            })
         else:
             return jsonify({
                 "status": "error",
@@ -926,13 +1448,6 @@ def capture_base64():
                 
     except Exception as e:
         print(f"Base64 capture error: {e}")
-        # Clean up temporary camera on error if we started it
-        if temp_camera and camera_stream.picam2:
-            try:
-                camera_stream.picam2.stop()
-                camera_stream.picam2 = None
-            except:
-                pass
         
         return jsonify({
             "status": "error",
@@ -950,6 +1465,7 @@ def video_hls():
         "error": "HLS streaming not yet implemented",
         "alternatives": {
             "mjpeg_stream": "/video_feed",
+            "h264_stream": "/video_feed_h264",
             "single_frame": "/capture",
             "canvas_solution": "/video_canvas_stream"
         }
@@ -960,56 +1476,60 @@ def video_canvas_stream():
     """Stream individual frames as JSON for canvas-based rendering in React"""
     def generate_json_frames():
         frame_count = 0
-        while camera_stream.web_streaming and camera_stream.streaming:
-            with camera_stream.lock:
-                if camera_stream.picam2:
-                    try:
-                        # Capture frame
-                        frame = camera_stream.picam2.capture_array()
-                        image = Image.fromarray(frame)
-                        
-                        # Convert to RGB if needed
-                        if image.mode == 'RGBA':
-                            rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-                            rgb_image.paste(image, mask=image.split()[-1])
-                            image = rgb_image
-                        elif image.mode != 'RGB':
-                            image = image.convert('RGB')
-                        
-                        # Convert to base64
-                        img_io = io.BytesIO()
-                        image.save(img_io, format='JPEG', quality=80)
-                        img_io.seek(0)
-                        
-                        import base64
-                        img_base64 = base64.b64encode(img_io.read()).decode('utf-8')
-                        
-                        frame_count += 1
-                        
-                        # Create JSON frame
-                        frame_data = {
-                            "frame": frame_count,
-                            "timestamp": time.time(),
-                            "image": f"data:image/jpeg;base64,{img_base64}",
-                            "size": image.size
-                        }
-                        
-                        # Send as Server-Sent Events (SSE)
-                        yield f"data: {json.dumps(frame_data)}\n\n"
-                        
-                    except Exception as e:
-                        error_data = {
-                            "error": str(e),
-                            "timestamp": time.time()
-                        }
-                        yield f"data: {json.dumps(error_data)}\n\n"
+        frame_interval = 0.1  # 10 FPS for canvas streaming
+        next_deadline = time.monotonic() + frame_interval
+        output = camera_stream.streaming_output
+        frame_ready = output.subscribe()
+        try:
+            while camera_stream.web_streaming and camera_stream.streaming:
+                # Reuse the capture thread's JPEG rather than capturing under the camera lock
+                if not frame_ready.wait(timeout=2.0):
+                    # SSE comment: keeps proxies from timing out the idle stream and
+                    # lets the server notice a client that went away in the meantime
+                    yield SSE_KEEPALIVE
+                    continue
+                frame_ready.clear()
+                frame_bytes = output.frame
+                if frame_bytes is None:
+                    continue
+                
+                try:
+                    frame_count += 1
+                    
+                    # Create JSON frame
+                    frame_data = {
+                        "frame": frame_count,
+                        "timestamp": time.time(),
+                        "image": camera_stream.frame_data_uri(frame_bytes),
+                        "size": camera_stream._current_main_size
+                    }
+                    
+                    # Send as Server-Sent Events (SSE)
+                    yield sse_event(frame_data)
+                    
+                except Exception as e:
+                    error_data = {
+                        "error": str(e),
+                        "timestamp": time.time()
+                    }
+                    yield sse_event(error_data)
                         
-            time.sleep(0.1)  # 10 FPS for canvas streaming
+                # Sleep only for what's left of this frame's slot; if sending
+                # overran it, start a fresh slot instead of trying to catch up
+                slack = next_deadline - time.monotonic()
+                if slack > 0:
+                    time.sleep(slack)
+                    next_deadline += frame_interval
+                else:
+                    next_deadline = time.monotonic() + frame_interval
+        finally:
+            output.unsubscribe(frame_ready)
     
-    # Import json at the top if not already imported
-    import json
+    # Every SSE viewer holds a server thread, like the MJPEG ones
+    if not camera_stream.add_client():
+        return stream_limit_response()
     
-    response = Response(generate_json_frames(), mimetype='text/event-stream')
+    response = Response(counted_stream(generate_json_frames()), mimetype='text/event-stream')
     response.headers['Cache-Control'] = 'no-cache'
     response.headers['Connection'] = 'keep-alive'
     response.headers['X-Accel-Buffering'] = 'no'
@@ -1034,12 +1554,26 @@ def react_example():
     return render_template('react_example.html')
 
 def run_flask_server():
-    """Run Flask server in a separate thread"""
-    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True, use_reloader=False)
+    """Run the web server in a separate thread"""
+    pin_to_cores(WEB_CORES)  # Inherited by the server's worker threads
+    if serve is None:
+        print("waitress not installed, using the Flask development server")
+        app.run(host='0.0.0.0', port=5000, debug=False, threaded=True, use_reloader=False)
+        return
+    
+    # Production WSGI server: pooled worker threads and prompt cleanup of
+    # disconnected MJPEG clients. A small output high-water mark makes a slow
+    # viewer's generator block after a few frames, so it skips ahead to the
+    # latest frame instead of queueing up to 16 MB of stale ones
+    serve(app, host='0.0.0.0', port=5000, threads=SERVER_THREADS, connection_limit=64,
+          channel_timeout=30, outbuf_high_watermark=256 * 1024, asyncore_use_poll=True)
 
 def main():
     """Main function to be called by run_stream.py or directly"""
     try:
+        pin_to_cores(APP_CORES)
+        camera_stream.network_monitor.start()
+        
         # Start Flask server in background thread
         flask_thread = threading.Thread(target=run_flask_server)
         flask_thread.daemon = True
@@ -1060,7 +1594,8 @@ def main():
         camera_stream.stop_streaming()
         if camera_stream.lcd:
             camera_stream.lcd.LCD_Clear()
-        GPIO.cleanup()
+        if GPIO is not None:
+            GPIO.cleanup()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
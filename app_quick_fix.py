@@ -50,12 +50,7 @@ def get_cors_origin(request_origin):
 # Add CORS headers to all responses
 @app.after_request
 def after_request(response):
-    try:
-        from flask import request as flask_request
-        origin = flask_request.headers.get('Origin')
-    except:
-        # Fallback for any import issues
-        origin = '*'
+    origin = request.headers.get('Origin')
     
     cors_origin = get_cors_origin(origin)
     
@@ -71,11 +66,7 @@ def after_request(response):
 # Handle preflight OPTIONS requests
 @app.route('/<path:path>', methods=['OPTIONS'])
 def handle_options(path):
-    try:
-        from flask import request as flask_request
-        origin = flask_request.headers.get('Origin')
-    except:
-        origin = '*'
+    origin = request.headers.get('Origin')
     
     cors_origin = get_cors_origin(origin)
     
@@ -10,6 +10,45 @@ from urllib.parse import urljoin
 from PIL import Image
 import time
 import io
+import threading
+import queue
+
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None  # Fall back to Pillow's JPEG decoder
+
+def decode_jpeg(jpeg_data, size=None, scale=1, buffer=None):
+    """
+    Decode JPEG bytes into a PIL Image, with libjpeg-turbo (simplejpeg) when available
+    
+    Args:
+        jpeg_data (bytes): The JPEG file contents
+        size (tuple): Optional (width, height) the caller needs. Lets libjpeg
+                      decode at 1/2, 1/4 or 1/8 scale for small previews
+        scale (int): Optional 1, 2, 4 or 8 to always decode at 1/scale size
+        buffer (bytearray): Optional scratch buffer for the decoded pixels, reused
+                            across calls and grown as needed (simplejpeg only)
+    """
+    if simplejpeg is not None:
+        height, width = simplejpeg.decode_jpeg_header(jpeg_data)[:2]
+        if scale > 1 and not size:
+            size = (width // scale, height // scale)
+        min_width, min_height = size or (0, 0)
+        if buffer is not None and len(buffer) < width * height * 3:
+            buffer.extend(bytes(width * height * 3 - len(buffer)))
+        pixels = simplejpeg.decode_jpeg(jpeg_data, colorspace='RGB', min_width=min_width,
+                                        min_height=min_height, buffer=buffer)
+        # Pillow copies RGB pixels into its own storage, so the buffer is free again
+        return Image.fromarray(pixels)
+    
+    image = Image.open(io.BytesIO(jpeg_data))
+    if scale > 1 and not size:
+        size = (image.width // scale, image.height // scale)
+    if size:
+        # Must run before load() so the IDCT itself is scaled
+        image.draft('RGB', size)
+    return image
 
 class PiCameraClient:
     def __init__(self, server_url="http://localhost:5000"):
@@ -22,10 +61,16 @@ class PiCameraClient:
         self.server_url = server_url
         self.session = requests.Session()
         
+        # Endpoint URLs, joined once rather than on every call
+        self.status_url = urljoin(server_url, "/status")
+        self.start_url = urljoin(server_url, "/start_stream")
+        self.stop_url = urljoin(server_url, "/stop_stream")
+        self.feed_url = urljoin(server_url, "/video_feed")
+        
     def get_status(self):
         """Get the current streaming status"""
         try:
-            response = self.session.get(urljoin(self.server_url, "/status"))
+            response = self.session.get(self.status_url)
             return response.json()
         except Exception as e:
             print(f"Error getting status: {e}")
@@ -34,7 +79,7 @@ class PiCameraClient:
     def start_stream(self):
         """Start the camera stream"""
         try:
-            response = self.session.post(urljoin(self.server_url, "/start_stream"))
+            response = self.session.post(self.start_url)
             return response.json()
         except Exception as e:
             print(f"Error starting stream: {e}")
@@ -43,36 +88,113 @@ class PiCameraClient:
     def stop_stream(self):
         """Stop the camera stream"""
         try:
-            response = self.session.post(urljoin(self.server_url, "/stop_stream"))
+            response = self.session.post(self.stop_url)
             return response.json()
         except Exception as e:
             print(f"Error stopping stream: {e}")
             return None
             
-    def get_frame(self):
-        """Get a single frame from the video stream as PIL Image"""
+    def get_frame(self, size=None, scale=1):
+        """
+        Get a single frame from the video stream as PIL Image
+        
+        Args:
+            size (tuple): Optional (width, height) the caller needs. Lets libjpeg
+                          decode at 1/2, 1/4 or 1/8 scale for small previews
+            scale (int): Optional 1, 2, 4 or 8 to decode at 1/scale size
+        """
         try:
-            response = self.session.get(urljoin(self.server_url, "/video_feed"), 
-                                      stream=True, timeout=5)
-            
-            # Read the multipart response
-            for chunk in response.iter_content(chunk_size=1024):
-                if b'\xff\xd8' in chunk:  # JPEG start marker
-                    # Find the start and end of the JPEG
-                    start = chunk.find(b'\xff\xd8')
-                    end = chunk.find(b'\xff\xd9')
-                    
-                    if start != -1 and end != -1:
-                        jpeg_data = chunk[start:end+2]
-                        
-                        # Convert to PIL Image
-                        image = Image.open(io.BytesIO(jpeg_data))
-                        return image
+            # Closing the response hangs up, freeing the server's stream slot
+            with self.session.get(self.feed_url, stream=True, timeout=5) as response:
+                for jpeg_data in self._iter_jpeg_frames(response):
+                    return decode_jpeg(jpeg_data, size, scale)
                         
         except Exception as e:
             print(f"Error getting frame: {e}")
             return None
             
+    @staticmethod
+    def _content_length(part_header):
+        """Content-Length from a multipart part header, or None if absent"""
+        for line in bytes(part_header).split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                try:
+                    return int(value)
+                except ValueError:
+                    return None
+        return None
+        
+    def _iter_jpeg_frames(self, response):
+        """Yield each JPEG in a streaming multipart MJPEG response as bytes"""
+        buffer = bytearray()
+        length = None  # Size of the current part, from its Content-Length header
+        search_from = 2  # Where to resume looking for the end-of-image marker
+        
+        # The server sends chunked transfer encoding with each frame in its own
+        # chunk, so reading whole chunks as they arrive takes one iteration per
+        # frame instead of one per KB. A fixed larger size would stall until
+        # that many bytes arrived, so unchunked responses stay at 1 KB reads
+        chunk_size = None if getattr(response.raw, 'chunked', False) else 1024
+        
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            buffer.extend(chunk)
+            
+            while True:
+                if length is None and not buffer.startswith(b'\xff\xd8'):
+                    # Between frames: parse the part header once all of it is here
+                    header_end = buffer.find(b'\r\n\r\n')
+                    start = buffer.find(b'\xff\xd8')
+                    if header_end != -1 and (start == -1 or header_end < start):
+                        length = self._content_length(buffer[:header_end])
+                        del buffer[:header_end + 4]
+                        search_from = 2
+                        continue
+                    if start == -1:
+                        break  # Wait for the rest of the header
+                    del buffer[:start]
+                    search_from = 2
+                
+                if length is not None:
+                    # Sized part: cut the frame out without scanning it
+                    if len(buffer) < length:
+                        break
+                    yield bytes(buffer[:length])
+                    del buffer[:length]
+                    length = None
+                    continue
+                
+                # Unsized part: only search the bytes that arrived since the last
+                # attempt, backing up one in case the marker straddles two chunks
+                end = buffer.find(b'\xff\xd9', search_from)
+                if end == -1:
+                    search_from = max(2, len(buffer) - 1)
+                    break
+                
+                yield bytes(buffer[:end + 2])
+                del buffer[:end + 2]
+                search_from = 2
+            
+    def _read_frames(self, frames, stop):
+        """Reader thread: queue stream frames, dropping the oldest when the consumer lags"""
+        # Sessions aren't thread-safe, so this thread doesn't share self.session
+        with requests.Session() as session:
+            while not stop.is_set():
+                try:
+                    with session.get(self.feed_url, stream=True, timeout=10) as response:
+                        for jpeg_data in self._iter_jpeg_frames(response):
+                            if stop.is_set():
+                                break  # Closing the response frees the server's stream slot
+                            if frames.full():
+                                try:
+                                    frames.get_nowait()
+                                except queue.Empty:
+                                    pass
+                            frames.put_nowait(jpeg_data)
+                except Exception as e:
+                    print(f"Stream reader error: {e}")
+                stop.wait(1)  # Reconnect after the stream ends or fails
+            
     def stream_and_display(self, save_frames=False, output_dir="frames"):
         """
         Stream video from the Pi camera and display using PIL
@@ -87,56 +209,73 @@ class PiCameraClient:
             os.makedirs(output_dir, exist_ok=True)
             frame_count = 0
             
+            # Files are written on their own thread so a slow SD card never
+            # holds up reading the stream
+            writes = queue.Queue(maxsize=64)
+            writer = threading.Thread(target=self._write_frames, args=(writes,))
+            writer.daemon = True
+            writer.start()
+            
         print("Starting video stream...")
         print("Note: This example saves frames but doesn't display them in real-time")
         print("For real-time display, consider using tkinter or another GUI library")
         print("Press Ctrl+C to quit")
         
         try:
-            response = self.session.get(urljoin(self.server_url, "/video_feed"), 
-                                      stream=True, timeout=10)
+            response = self.session.get(self.feed_url, stream=True, timeout=10)
             
-            bytes_data = b''
-            
-            for chunk in response.iter_content(chunk_size=1024):
-                bytes_data += chunk
-                
-                # Look for JPEG boundaries
-                start = bytes_data.find(b'\xff\xd8')
-                end = bytes_data.find(b'\xff\xd9')
-                
-                if start != -1 and end != -1:
-                    jpeg_data = bytes_data[start:end+2]
-                    bytes_data = bytes_data[end+2:]
+            for jpeg_data in self._iter_jpeg_frames(response):
+                # Only the header is parsed here; PIL decodes lazily
+                try:
+                    image = Image.open(io.BytesIO(jpeg_data))
                     
-                    # Decode frame using PIL
-                    try:
-                        image = Image.open(io.BytesIO(jpeg_data))
+                    if save_frames:
+                        filename = f"{output_dir}/frame_{frame_count:06d}.jpg"
+                        # Already a JPEG: save the received bytes rather than re-encoding
+                        writes.put((filename, jpeg_data))
+                        frame_count += 1
                         
-                        if save_frames:
-                            filename = f"{output_dir}/frame_{frame_count:06d}.jpg"
-                            image.save(filename)
-                            frame_count += 1
-                            
-                            if frame_count % 30 == 0:  # Print every 30 frames
-                                print(f"Saved {frame_count} frames... (Latest: {image.size})")
-                        else:
-                            # Just print frame info without saving
-                            print(f"Received frame: {image.size}, mode: {image.mode}")
-                            
-                    except Exception as e:
-                        print(f"Error processing frame: {e}")
-                        continue
+                        if frame_count % 30 == 0:  # Print every 30 frames
+                            print(f"Saved {frame_count} frames... (Latest: {image.size})")
+                    else:
+                        # Just print frame info without saving
+                        print(f"Received frame: {image.size}, mode: {image.mode}")
+                        
+                except Exception as e:
+                    print(f"Error processing frame: {e}")
+                    continue
                                 
         except KeyboardInterrupt:
             print("\nStream interrupted by user")
         except Exception as e:
             print(f"Streaming error: {e}")
+        finally:
+            if save_frames:
+                # Let the writer finish the frames still queued
+                writes.put(None)
+                writer.join()
+            
+    def _write_frames(self, writes):
+        """Writer thread: save (filename, jpeg_data) items until it receives None"""
+        while True:
+            item = writes.get()
+            if item is None:
+                break
+            filename, jpeg_data = item
+            try:
+                with open(filename, 'wb') as f:
+                    f.write(jpeg_data)
+            except OSError as e:
+                print(f"Error saving frame {filename}: {e}")
             
-    def stream_to_tkinter(self):
+    def stream_to_tkinter(self, preview_scale=1):
         """
         Stream video and display in a tkinter window
         This is an optional method that requires tkinter
+        
+        Args:
+            preview_scale (int): 1, 2, 4 or 8 to show frames at 1/preview_scale
+                                 size, decoded at that size rather than resized
         """
         try:
             import tkinter as tk
@@ -158,28 +297,49 @@ class PiCameraClient:
         status_label = ttk.Label(root, text="Connecting...")
         status_label.pack()
         
+        # One long-lived stream read on its own thread, so decoding and drawing
+        # never hold up the network reads (and no connection per frame)
+        frames = queue.Queue(maxsize=2)
+        decode_buffer = bytearray()  # Pixel memory reused by every decode
+        stop_reading = threading.Event()  # Set once the window closes
+        reader = threading.Thread(target=self._read_frames, args=(frames, stop_reading))
+        reader.daemon = True
+        reader.start()
+        
+        photo = None  # Tk image shown in video_label, repainted for each frame
+        
         def update_frame():
+            nonlocal photo
             try:
-                image = self.get_frame()
-                if image:
-                    # Convert PIL image to tkinter PhotoImage
-                    photo = ImageTk.PhotoImage(image)
-                    video_label.configure(image=photo)
-                    video_label.image = photo  # Keep a reference
+                # Skip straight to the newest frame the reader has queued
+                jpeg_data = None
+                while not frames.empty():
+                    jpeg_data = frames.get_nowait()
+                
+                if jpeg_data:
+                    image = decode_jpeg(jpeg_data, scale=preview_scale, buffer=decode_buffer)
+                    if photo is not None and (photo.width(), photo.height()) == image.size:
+                        # Paint into the existing Tk image rather than creating
+                        # (and reconfiguring the label with) a new one per frame
+                        photo.paste(image)
+                    else:
+                        # Convert PIL image to tkinter PhotoImage
+                        photo = ImageTk.PhotoImage(image)
+                        video_label.configure(image=photo)
+                        video_label.image = photo  # Keep a reference
                     status_label.configure(text=f"Streaming - {image.size}")
-                else:
-                    status_label.configure(text="No frame received")
             except Exception as e:
                 status_label.configure(text=f"Error: {e}")
                 
             # Schedule next update
-            root.after(100, update_frame)  # Update every 100ms
+            root.after(33, update_frame)  # Check for a new frame ~30 times a second
             
         # Start the update loop
         update_frame()
         
         print("Starting tkinter display. Close window to stop.")
         root.mainloop()
+        stop_reading.set()
 
 def main():
     """Example usage of the Pi Camera client"""
@@ -8,8 +8,9 @@ import re
 with open('app.py', 'r') as f:
     content = f.read()
 
-# Add request import if not present
-if 'from flask import' in content and 'request' not in content:
+# Add request import if not present ('request' alone also matches words
+# like 'requests' elsewhere in the file, so look at the import line itself)
+if 'from flask import Flask, Response, render_template, jsonify\n' in content:
     content = content.replace(
         'from flask import Flask, Response, render_template, jsonify',
         'from flask import Flask, Response, render_template, jsonify, request'
@@ -49,6 +50,26 @@ def get_cors_origin(request_origin):
         return request_origin if request_origin else '*'
     return None
 
+# CORS headers that don't depend on the request; browsers may cache
+# preflights for up to a day (Chromium caps this at 2 hours)
+CORS_HEADERS = (
+    ('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-Requested-With'),
+    ('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS'),
+    ('Access-Control-Allow-Credentials', 'true'),
+    ('Access-Control-Max-Age', '86400'),
+)
+
+def _apply_cors(response, origin):
+    """Set the CORS headers for an allowed origin; returns False if it isn't allowed"""
+    cors_origin = get_cors_origin(origin)
+    if not cors_origin:
+        return False
+    # Set rather than added, so applying them twice leaves one copy of each
+    response.headers['Access-Control-Allow-Origin'] = cors_origin
+    for name, value in CORS_HEADERS:
+        response.headers[name] = value
+    return True
+
 '''
 
 # Replace the old CORS configuration
@@ -56,16 +77,7 @@ old_cors_pattern = r'# Add CORS headers to all responses\s*@app\.after_request\s
 new_cors_after_request = '''# Add CORS headers to all responses
 @app.after_request
 def after_request(response):
-    origin = request.headers.get('Origin')
-    cors_origin = get_cors_origin(origin)
-    
-    if cors_origin:
-        response.headers.add('Access-Control-Allow-Origin', cors_origin)
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-Requested-With')
-        response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
-        response.headers.add('Access-Control-Allow-Credentials', 'true')
-        response.headers.add('Access-Control-Max-Age', '3600')  # Cache preflight for 1 hour
-    
+    _apply_cors(response, request.headers.get('Origin'))
     return response'''
 
 # Replace the old OPTIONS handler
@@ -73,19 +85,9 @@ old_options_pattern = r'# Handle preflight OPTIONS requests\s*@app\.route\(.*?\)
 new_options_handler = '''# Handle preflight OPTIONS requests
 @app.route('/<path:path>', methods=['OPTIONS'])
 def handle_options(path):
-    origin = request.headers.get('Origin')
-    cors_origin = get_cors_origin(origin)
-    
     response = Response()
-    if cors_origin:
-        response.headers.add('Access-Control-Allow-Origin', cors_origin)
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-Requested-With')
-        response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
-        response.headers.add('Access-Control-Allow-Credentials', 'true')
-        response.headers.add('Access-Control-Max-Age', '3600')
-    else:
+    if not _apply_cors(response, request.headers.get('Origin')):
         response.status_code = 403
-    
     return response'''
 
 # Add CORS test route